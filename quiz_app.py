@@ -2,16 +2,27 @@
 """
 TADM23 クイズアプリ
 Streamlitベースの学習用クイズアプリケーション（スマホ最適化版）
-Google Sheetsで永続化 + 選択肢ランダム化
+ローカルのSQLiteに保存し、Google Sheetsへバックグラウンドで同期 + 選択肢ランダム化
 """
 
 import streamlit as st
-import json
+import base64
+import logging
 import random
-import hashlib
+import re
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from array import array
 from datetime import datetime
 from pathlib import Path
+from types import MappingProxyType
+import numpy as np
+import orjson
 import pandas as pd
+from sortedcontainers import SortedSet
 from streamlit_gsheets import GSheetsConnection
 
 # ページ設定（スマホ向けにcenteredレイアウト）
@@ -23,7 +34,7 @@ st.set_page_config(
 )
 
 # スマホ向けカスタムCSS
-st.markdown("""
+CUSTOM_CSS = """
 <style>
     .block-container {
         padding-top: 1rem;
@@ -105,13 +116,34 @@ st.markdown("""
         font-size: 0.85em;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+def inject_css():
+    """カスタムCSSを挿入
+
+    Streamlitは再実行時に出力されなかった要素を画面から消すため、
+    キャッシュせず毎回出力する（文字列はモジュール読み込み時に一度だけ作成）。
+    """
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 
 # =============================================================================
 # Google Sheets データベース関連
 # =============================================================================
 
+USERDATA_COLUMNS = ["user_id", "history", "marked", "stats", "last_question_index", "updated_at"]
+
+# 保存の最小間隔（秒）。この間隔内の保存要求はまとめて次回に書き込む
+SAVE_INTERVAL_SEC = 10
+
+# バックグラウンドでGoogle Sheetsへ同期する間隔（秒）
+SHEETS_SYNC_INTERVAL_SEC = 30
+
+# 同期スレッドを起動できなかった場合に、再び起動を試みるまでの間隔（秒）
+SHEETS_SYNC_RETRY_SEC = 300
+
+
 def get_user_id():
     """ユーザーIDを取得（ブラウザセッションごとにユニーク）"""
     if "user_id" not in st.session_state:
@@ -121,7 +153,7 @@ def get_user_id():
             st.session_state.user_id = params["uid"]
         else:
             # 新しいユーザーIDを生成
-            new_id = hashlib.md5(f"{datetime.now().isoformat()}{random.random()}".encode()).hexdigest()[:12]
+            new_id = secrets.token_hex(6)
             st.session_state.user_id = new_id
             st.query_params["uid"] = new_id
     return st.session_state.user_id
@@ -137,28 +169,63 @@ def get_gsheets_connection():
         return None
 
 
-def load_user_data_from_sheets():
-    """Google Sheetsからユーザーデータを読み込む"""
+def has_userdata_layout(df):
+    """シートの列がUSERDATA_COLUMNSの順に並んでいるか（行単位で書き込めるか）"""
+    return list(df.columns[:len(USERDATA_COLUMNS)]) == USERDATA_COLUMNS
+
+
+def index_userdata_df(df):
+    """user_idで行を引けるようにインデックスを設定（列としても残す）"""
+    return df.set_index("user_id", drop=False)
+
+
+def find_user_position(df, user_id):
+    """user_idの行位置（ヘッダーを除いた0始まり、見つからなければ-1）"""
+    return int(df.index.get_indexer_for([user_id])[0])
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def read_userdata_df():
+    """UserDataワークシート全体を読み込む（書き込み時にキャッシュをクリア）"""
     conn = get_gsheets_connection()
     if conn is None:
         return None
-    
+    df = conn.read(worksheet="UserData", ttl=0)
+    # 空のシートなどuser_id列がない場合はインデックスを設定せずに返す
+    if df is None or df.empty or "user_id" not in df.columns:
+        return df
+    return index_userdata_df(df)
+
+
+def load_user_data_from_sheets():
+    """Google Sheetsからユーザーデータを読み込む"""
     try:
-        df = conn.read(worksheet="UserData", ttl=5)
+        df = read_userdata_df()
         if df is None or df.empty:
             return None
+        st.session_state.userdata_df = df
         
         user_id = get_user_id()
-        user_row = df[df["user_id"] == user_id]
+        position = find_user_position(df, user_id)
         
-        if user_row.empty:
+        if position < 0:
             return None
         
-        row = user_row.iloc[0]
+        # 列順が想定どおりなら、保存時に1行だけ更新できるよう行番号を記録
+        # （読み込み時に空行が詰められるため、行番号はA列から探す）
+        if has_userdata_layout(df):
+            try:
+                user_ids = get_userdata_worksheet().col_values(1)
+                if user_id in user_ids[1:]:
+                    st.session_state.userdata_rows[user_id] = user_ids.index(user_id, 1) + 1
+            except Exception:
+                pass
+        
+        row = df.iloc[position]
         return {
-            "history": json.loads(row["history"]) if pd.notna(row["history"]) else {},
-            "marked": json.loads(row["marked"]) if pd.notna(row["marked"]) else [],
-            "stats": json.loads(row["stats"]) if pd.notna(row["stats"]) else {"correct": 0, "incorrect": 0, "total": 0},
+            "history": decode_history(row["history"], len(st.session_state.questions)) if pd.notna(row["history"]) else None,
+            "marked": orjson.loads(row["marked"]) if pd.notna(row["marked"]) else [],
+            "stats": orjson.loads(row["stats"]) if pd.notna(row["stats"]) else {"correct": 0, "incorrect": 0, "total": 0},
             "last_question_index": int(row["last_question_index"]) if pd.notna(row.get("last_question_index")) else 0
         }
     except Exception as e:
@@ -166,88 +233,492 @@ def load_user_data_from_sheets():
         st.error(f"Google Sheets読み込みエラー: {e}")
         return None
 
-def save_user_data_to_sheets():
-    """Google Sheetsにユーザーデータを保存"""
+
+@st.cache_resource
+def get_userdata_worksheet():
+    """UserDataワークシート（gspread）を取得"""
+    conn = get_gsheets_connection()
+    if conn is None:
+        return None
+    return conn.client._select_worksheet(worksheet="UserData")
+
+
+def user_cell_ranges(row, cells):
+    """{列名: 値} をbatch_update用のセル範囲のリストに変換"""
+    return [
+        {"range": f"{chr(ord('A') + USERDATA_COLUMNS.index(col))}{row}", "values": [[value]]}
+        for col, value in cells.items()
+    ]
+
+
+def append_user_row(worksheet, values):
+    """ユーザーの行をシート末尾に1行だけ追加し、追加先の行番号を返す"""
+    response = worksheet.append_row(values, value_input_option="RAW", table_range="A1")
+    # updatedRangeは "UserData!A5:F5" の形式
+    return int(re.search(r"(\d+)$", response["updates"]["updatedRange"]).group(1))
+
+
+def mark_dirty(*fields):
+    """保存が必要な列を記録"""
+    st.session_state.dirty_fields.update(fields)
+
+
+def serialize_user_field(col):
+    """UserDataの1列分の値を作成"""
+    if col == "user_id":
+        return get_user_id()
+    if col == "history":
+        return encode_history(st.session_state.correct_bits, st.session_state.history_attempts)
+    if col == "marked":
+        return orjson.dumps(list(st.session_state.marked_questions)).decode()
+    if col == "stats":
+        return orjson.dumps(st.session_state.current_session_stats).decode()
+    if col == "last_question_index":
+        # 現在表示中の問題インデックスを取得
+        filtered_indices = get_filtered_indices()
+        if filtered_indices and st.session_state.current_index < len(filtered_indices):
+            return filtered_indices[st.session_state.current_index]
+        return 0
+    if col == "updated_at":
+        return datetime.now().isoformat()
+    raise KeyError(col)
+
+
+def save_user_data_to_sheets(force=False):
+    """Google Sheetsにユーザーデータ（mark_dirtyで記録した列）を直接保存
+
+    バックグラウンド同期が使えない場合に使う。前回の保存から
+    SAVE_INTERVAL_SEC秒以内の呼び出しは保留にし、force=Trueの場合のみ即座に書き込む。
+    """
+    dirty_fields = st.session_state.dirty_fields
+    if not dirty_fields:
+        return
+    if not force and time.time() - st.session_state.get("last_save_ts", 0.0) < SAVE_INTERVAL_SEC:
+        return
+    
     conn = get_gsheets_connection()
     if conn is None:
         return
     
+    st.session_state.last_save_ts = time.time()
     user_id = get_user_id()
     
-    # 現在表示中の問題インデックスを取得
-    filtered_indices = get_filtered_indices()
-    if filtered_indices and st.session_state.current_index < len(filtered_indices):
-        last_question_index = filtered_indices[st.session_state.current_index]
-    else:
-        last_question_index = 0
+    # シート上の行番号が分かっていれば、その行の変更された列だけを更新
+    row = st.session_state.userdata_rows.get(user_id)
+    if row is not None:
+        try:
+            cols = [col for col in USERDATA_COLUMNS if col in dirty_fields] + ["updated_at"]
+            get_userdata_worksheet().batch_update(
+                user_cell_ranges(row, {col: serialize_user_field(col) for col in cols})
+            )
+            read_userdata_df.clear()
+            dirty_fields.clear()
+            return
+        except Exception:
+            # 行単位で書き込めない場合はシート全体の書き込みにフォールバック
+            st.session_state.userdata_rows.pop(user_id, None)
     
-    # 保存データを準備
-    save_data = {
-        "user_id": user_id,
-        "history": json.dumps({str(k): v for k, v in st.session_state.get("history", {}).items()}),
-        "marked": json.dumps(list(st.session_state.get("marked_questions", set()))),
-        "stats": json.dumps(st.session_state.get("current_session_stats", {"correct": 0, "incorrect": 0, "total": 0})),
-        "last_question_index": last_question_index,
-        "updated_at": datetime.now().isoformat()
-    }
+    # 行全体を書き込む場合は全列を用意
+    save_data = {col: serialize_user_field(col) for col in USERDATA_COLUMNS}
+    
+    # 未登録ユーザーでシートにヘッダーがあれば、末尾に1行だけ追加
+    known_df = st.session_state.get("userdata_df")
+    if known_df is not None and has_userdata_layout(known_df) and user_id not in known_df.index:
+        try:
+            st.session_state.userdata_rows[user_id] = append_user_row(get_userdata_worksheet(), list(save_data.values()))
+            read_userdata_df.clear()
+            dirty_fields.clear()
+            return
+        except Exception:
+            pass
     
     try:
-        # 既存データを読み込み
+        # シート全体を書き換えるので、他のセッションの変更を消さないよう直前に読み直す
         try:
             df = conn.read(worksheet="UserData", ttl=0)
             if df is None or df.empty:
-                df = pd.DataFrame(columns=["user_id", "history", "marked", "stats", "last_question_index", "updated_at"])
+                df = pd.DataFrame(columns=USERDATA_COLUMNS)
         except:
-            df = pd.DataFrame(columns=["user_id", "history", "marked", "stats", "last_question_index", "updated_at"])
+            df = pd.DataFrame(columns=USERDATA_COLUMNS)
+        df = index_userdata_df(df)
+        
+        # 列順を固定（行単位の更新でA〜F列に対応させるため）。それ以外の列は後ろに残す
+        extra_columns = [col for col in df.columns if col not in USERDATA_COLUMNS]
+        df = df.reindex(columns=USERDATA_COLUMNS + extra_columns).astype(object)
         
         # ユーザーの行を更新または追加
-        if user_id in df["user_id"].values:
-            idx = df[df["user_id"] == user_id].index[0]
-            for col, val in save_data.items():
-                df.at[idx, col] = val
+        position = find_user_position(df, user_id)
+        if position >= 0:
+            df.iloc[position, :len(USERDATA_COLUMNS)] = list(save_data.values())
         else:
-            df = pd.concat([df, pd.DataFrame([save_data])], ignore_index=True)
+            df = pd.concat([df, index_userdata_df(pd.DataFrame([save_data]))])
+            position = len(df) - 1
         
         # 保存
         conn.update(worksheet="UserData", data=df)
+        read_userdata_df.clear()
+        st.session_state.userdata_df = df
+        # ヘッダー行の分だけずらしたシート上の行番号を記録
+        st.session_state.userdata_rows[user_id] = position + 2
+        dirty_fields.clear()
         
     except Exception as e:
         st.toast(f"保存エラー: {e}", icon="⚠️")
 
 
+def save_user_data(force=False):
+    """ユーザーデータをローカルDBに保存し、Google Sheetsへの同期を予約
+
+    回答履歴とマークは変更時にローカルDBへ書き込み済みのため、ここでは
+    統計と最後の問題インデックスを書き込む。ローカルDBに書き込めない場合や
+    同期スレッドを起動できない場合はGoogle Sheetsに直接保存する。
+    """
+    dirty_fields = st.session_state.dirty_fields
+    if not dirty_fields:
+        return
+    
+    user_id = get_user_id()
+    sync_queue = get_sheets_sync_queue() if write_local_db(save_local_meta, user_id) else None
+    if sync_queue is None:
+        save_user_data_to_sheets(force)
+        return
+    sync_queue.put((user_id, frozenset(dirty_fields), st.session_state.userdata_rows.get(user_id)))
+    dirty_fields.clear()
+
+
+def flush_pending_save():
+    """保留中の保存があれば書き込む"""
+    if st.session_state.dirty_fields:
+        save_user_data()
+
+
+# =============================================================================
+# ローカルDB（SQLite）とGoogle Sheetsへのバックグラウンド同期
+# =============================================================================
+
+LOCAL_DB_PATH = Path(__file__).parent / "users.db"
+
+# 同期スレッドのエラー出力用（スレッド内ではst.toastを使えないため）
+logger = logging.getLogger(__name__)
+
+LOCAL_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    user_id TEXT NOT NULL,
+    q_idx INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    PRIMARY KEY (user_id, q_idx)
+);
+CREATE TABLE IF NOT EXISTS marked (
+    user_id TEXT NOT NULL,
+    q_idx INTEGER NOT NULL,
+    PRIMARY KEY (user_id, q_idx)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    user_id TEXT PRIMARY KEY,
+    last_idx INTEGER NOT NULL,
+    stats TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+
+@st.cache_resource
+def get_local_db():
+    """ローカルDB（WALモード）の接続と、スレッド間で共有するためのロックを取得"""
+    conn = sqlite3.connect(LOCAL_DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(LOCAL_DB_SCHEMA)
+    return conn, threading.Lock()
+
+
+def local_db_execute(sql, params=()):
+    """ローカルDBでSQLを実行して結果の行を返す"""
+    conn, lock = get_local_db()
+    with lock:
+        return conn.execute(sql, params).fetchall()
+
+
+def write_local_db(func, *args):
+    """ローカルDBへの書き込みを実行し、成功したかを返す
+
+    失敗した場合はエラーを表示し、このセッションではローカルDBを使わずに
+    Google Sheetsへ直接保存する（一部だけのローカルの内容をシートに同期しないため）。
+    """
+    if not st.session_state.get("local_db_enabled", True):
+        return False
+    try:
+        func(*args)
+        return True
+    except Exception as e:
+        st.session_state.local_db_enabled = False
+        st.toast(f"ローカル保存エラー: {e}", icon="⚠️")
+        return False
+
+
+def save_local_answer(user_id, question_idx, is_correct, attempts):
+    """1問分の回答履歴をローカルDBに書き込む"""
+    local_db_execute(
+        "INSERT INTO history (user_id, q_idx, correct, attempts) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (user_id, q_idx) DO UPDATE SET correct = excluded.correct, attempts = excluded.attempts",
+        (user_id, question_idx, int(is_correct), attempts),
+    )
+
+
+def save_local_marked(user_id, question_idx, marked):
+    """1問分のマーク状態をローカルDBに書き込む"""
+    if marked:
+        local_db_execute("INSERT OR IGNORE INTO marked (user_id, q_idx) VALUES (?, ?)", (user_id, question_idx))
+    else:
+        local_db_execute("DELETE FROM marked WHERE user_id = ? AND q_idx = ?", (user_id, question_idx))
+
+
+def clear_local_table(user_id, table):
+    """ユーザーの回答履歴（history）またはマーク（marked）をローカルDBから削除"""
+    if table not in ("history", "marked"):
+        raise ValueError(table)
+    local_db_execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+
+
+def save_local_meta(user_id):
+    """統計と最後の問題インデックスをローカルDBに書き込む"""
+    local_db_execute(
+        "INSERT INTO meta (user_id, last_idx, stats, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET "
+        "last_idx = excluded.last_idx, stats = excluded.stats, updated_at = excluded.updated_at",
+        (
+            user_id,
+            serialize_user_field("last_question_index"),
+            serialize_user_field("stats"),
+            serialize_user_field("updated_at"),
+        ),
+    )
+
+
+def save_local_user_data(user_id, data):
+    """Google Sheetsから読み込んだユーザーデータをローカルDBにまとめて書き込む"""
+    conn, lock = get_local_db()
+    rows = []
+    if data["history"] is not None:
+        correct_bits, attempts = data["history"]
+        correct_mask = bits_to_mask(correct_bits, len(attempts))
+        rows = [(user_id, i, int(correct_mask[i]), n) for i, n in enumerate(attempts) if n]
+    with lock:
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM marked WHERE user_id = ?", (user_id,))
+            conn.executemany("INSERT INTO history (user_id, q_idx, correct, attempts) VALUES (?, ?, ?, ?)", rows)
+            # シート上のマークに重複があっても取り込めるよう、重複は無視する
+            conn.executemany("INSERT OR IGNORE INTO marked (user_id, q_idx) VALUES (?, ?)", [(user_id, i) for i in data["marked"]])
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (user_id, last_idx, stats, updated_at) VALUES (?, ?, ?, ?)",
+                (user_id, data["last_question_index"], orjson.dumps(data["stats"]).decode(), datetime.now().isoformat()),
+            )
+        except Exception:
+            # 共有の接続がトランザクション中のまま残らないよう取り消す
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def load_user_data_from_local(user_id, num_questions):
+    """ローカルDBからユーザーデータを読み込む（未保存のユーザーはNone）"""
+    meta = local_db_execute("SELECT last_idx, stats, updated_at FROM meta WHERE user_id = ?", (user_id,))
+    if not meta:
+        return None
+    last_idx, stats, updated_at = meta[0]
+    
+    _, attempts = new_history(num_questions)
+    correct_mask = np.zeros(num_questions, dtype=bool)
+    for i, correct, n in local_db_execute("SELECT q_idx, correct, attempts FROM history WHERE user_id = ?", (user_id,)):
+        if i < num_questions:
+            attempts[i] = min(n, 0xFFFF)
+            correct_mask[i] = correct
+    marked = [i for (i,) in local_db_execute("SELECT q_idx FROM marked WHERE user_id = ? ORDER BY q_idx", (user_id,))]
+    
+    return {
+        "history": (mask_to_bits(correct_mask), attempts),
+        "marked": marked,
+        "stats": orjson.loads(stats),
+        "last_question_index": last_idx,
+        "updated_at": updated_at,
+    }
+
+
+def read_local_user_cells(user_id, num_questions):
+    """ローカルDBの内容からUserDataの1行分の値 {列名: 値} を作成"""
+    data = load_user_data_from_local(user_id, num_questions)
+    return {
+        "user_id": user_id,
+        "history": encode_history(*data["history"]),
+        "marked": orjson.dumps(data["marked"]).decode(),
+        "stats": orjson.dumps(data["stats"]).decode(),
+        "last_question_index": data["last_question_index"],
+        "updated_at": data["updated_at"],
+    }
+
+
+def push_pending_to_sheets(worksheet, pending, rows, num_questions):
+    """溜まった変更をGoogle Sheetsにまとめて書き込み、書き込めたユーザーをpendingから外す
+
+    書き込めなかったユーザーはpendingに残し、次回に再送する。
+    """
+    if any(user_id not in rows for user_id in pending):
+        # 行番号が分からないユーザーはA列（user_id）から探す
+        for row, user_id in enumerate(worksheet.col_values(1)[1:], start=2):
+            rows.setdefault(user_id, row)
+    
+    updates = {}  # user_id -> batch_update用のセル範囲
+    for user_id, fields in list(pending.items()):
+        try:
+            cells = read_local_user_cells(user_id, num_questions)
+            if user_id not in rows:
+                rows[user_id] = append_user_row(worksheet, [cells[col] for col in USERDATA_COLUMNS])
+                del pending[user_id]
+                continue
+            cols = [col for col in USERDATA_COLUMNS if col in fields] + ["updated_at"]
+            updates[user_id] = user_cell_ranges(rows[user_id], {col: cells[col] for col in cols})
+        except Exception:
+            logger.exception("Google Sheetsへの同期に失敗しました（user_id=%s）", user_id)
+    if not updates:
+        return
+    
+    try:
+        worksheet.batch_update([cell for cells in updates.values() for cell in cells])
+    except Exception:
+        # まとめて書き込めない場合は1ユーザーずつ書き込み、失敗したユーザーだけ残す
+        logger.exception("Google Sheetsへのまとめての書き込みに失敗しました")
+        for user_id, cells in updates.items():
+            try:
+                worksheet.batch_update(cells)
+            except Exception:
+                logger.exception("Google Sheetsへの同期に失敗しました（user_id=%s）", user_id)
+                continue
+            del pending[user_id]
+        return
+    for user_id in updates:
+        del pending[user_id]
+
+
+def sheets_sync_worker(sync_queue, worksheet, num_questions):
+    """保存要求をSHEETS_SYNC_INTERVAL_SECごとにまとめてGoogle Sheetsに書き込む（バックグラウンドスレッド）"""
+    pending = {}  # user_id -> 書き込む列
+    rows = {}  # user_id -> シート上の行番号
+    while True:
+        time.sleep(SHEETS_SYNC_INTERVAL_SEC)
+        while True:
+            try:
+                user_id, fields, row = sync_queue.get_nowait()
+            except queue.Empty:
+                break
+            pending.setdefault(user_id, set()).update(fields)
+            if row is not None:
+                rows[user_id] = row
+        if not pending:
+            continue
+        try:
+            push_pending_to_sheets(worksheet, pending, rows, num_questions)
+        except Exception:
+            # 書き込めなかった分はpendingに残り、次回に再送
+            logger.exception("Google Sheetsへの同期に失敗しました")
+
+
+@st.cache_resource
+def start_sheets_sync(num_questions):
+    """Google Sheetsへの同期スレッドを起動
+
+    (保存要求を渡すキュー, None) を返す。起動できない場合は失敗もキャッシュするため
+    (None, 再試行する時刻) を返し、保存のたびにSheetsへ問い合わせないようにする。
+    """
+    try:
+        worksheet = get_userdata_worksheet()
+        if worksheet is None:
+            raise RuntimeError("UserDataワークシートを取得できません")
+        header = worksheet.row_values(1)
+        if not header:
+            worksheet.append_row(USERDATA_COLUMNS, value_input_option="RAW", table_range="A1")
+        elif header[:len(USERDATA_COLUMNS)] != USERDATA_COLUMNS:
+            # 列の並びが違うシートは直接保存（シート全体の書き込み）で整える
+            raise RuntimeError("UserDataワークシートの列が想定と異なります")
+    except Exception:
+        return None, time.time() + SHEETS_SYNC_RETRY_SEC
+    
+    sync_queue = queue.Queue()
+    threading.Thread(
+        target=sheets_sync_worker,
+        args=(sync_queue, worksheet, num_questions),
+        name="sheets-sync",
+        daemon=True,
+    ).start()
+    return sync_queue, None
+
+
+def get_sheets_sync_queue():
+    """同期スレッドのキューを取得（起動できない場合はNone）"""
+    num_questions = len(st.session_state.questions)
+    sync_queue, retry_at = start_sheets_sync(num_questions)
+    if sync_queue is None and time.time() >= retry_at:
+        # 再試行の時刻を過ぎたらキャッシュした失敗を捨てて起動し直す
+        start_sheets_sync.clear()
+        sync_queue, _ = start_sheets_sync(num_questions)
+    return sync_queue
+
+
 # =============================================================================
 # 問題データ関連
 # =============================================================================
 
+def freeze(obj):
+    """dict/listを読み取り専用のMappingProxyType/tupleに再帰的に変換"""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def prepare_question(question):
+    """再描画のたびに計算しなくて済むよう、正解の情報と表示用HTMLを事前計算して付与"""
+    correct_set = frozenset(i for i, opt in enumerate(question["options"]) if opt["status"] == "correct")
+    question["_correct_set"] = correct_set
+    question["_correct_count"] = len(correct_set)
+    # 問題文・解説のHTMLも一度だけ組み立てる
+    question["_question_html"] = f'<div class="question-box">{question["question"]}</div>'
+    question["_explanation_html"] = (
+        f'<div class="explanation-box">📖 <b>解説</b><br>{question["explanation"]}</div>'
+        if question.get("explanation") else None
+    )
+    return question
+
+
+@st.cache_resource
 def load_questions():
-    """問題データを読み込む"""
+    """問題データを読み込む（全セッションで共有するため読み取り専用）"""
     json_path = Path(__file__).parent / "combined_output.json"
-    with open(json_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    questions = orjson.loads(json_path.read_bytes())
+    return freeze([prepare_question(q) for q in questions])
 
 
 def get_shuffled_options(question_idx):
     """問題の選択肢をシャッフルして返す（問題ごとに固定のシャッフル順）"""
-    # 問題インデックスとユーザーIDをシードにして、毎回同じ順番にする
+    # 問題インデックスとシャッフルシードから順序を決め、セッション内で保持する
     # ただし問題を切り替えるたびに新しい順序
-    key = f"option_order_{question_idx}"
+    option_orders = st.session_state.option_orders
     
-    if key not in st.session_state:
-        question = st.session_state.questions[question_idx]
-        indices = list(range(len(question["options"])))
-        # 問題インデックスをシードにしてシャッフル（セッション内では同じ順序）
-        rng = random.Random(f"{st.session_state.get('shuffle_seed', 0)}_{question_idx}")
-        rng.shuffle(indices)
-        st.session_state[key] = indices
+    if question_idx not in option_orders:
+        num_options = len(st.session_state.questions[question_idx]["options"])
+        # シードと問題インデックスから整数シードを作ってシャッフル（セッション内では同じ順序）
+        seed = (st.session_state.get("shuffle_seed", 0) * 2654435761) ^ question_idx
+        option_orders[question_idx] = random.Random(seed).sample(range(num_options), num_options)
     
-    return st.session_state[key]
+    return option_orders[question_idx]
 
 
 def reset_option_orders():
     """選択肢の順序をリセット"""
-    keys_to_remove = [k for k in st.session_state.keys() if k.startswith("option_order_")]
-    for k in keys_to_remove:
-        del st.session_state[k]
+    st.session_state.option_orders.clear()
     # 新しいシャッフルシードを設定
     st.session_state.shuffle_seed = random.randint(0, 1000000)
 
@@ -258,20 +729,37 @@ def reset_option_orders():
 
 def initialize_session_state():
     """セッション状態を初期化"""
+    if "userdata_rows" not in st.session_state:
+        st.session_state.userdata_rows = {}  # user_id -> シート上の行番号
+    if "dirty_fields" not in st.session_state:
+        st.session_state.dirty_fields = set()  # 未保存の変更がある列
     if "questions" not in st.session_state:
         st.session_state.questions = load_questions()
     
     if "shuffle_seed" not in st.session_state:
         st.session_state.shuffle_seed = random.randint(0, 1000000)
+    if "option_orders" not in st.session_state:
+        st.session_state.option_orders = {}  # 問題インデックス -> 選択肢の表示順
     
-    # Google Sheetsからデータを読み込み（初回のみ）
+    # ローカルDB、なければGoogle Sheetsからデータを読み込み（初回のみ）
     if "data_loaded" not in st.session_state:
         st.session_state.data_loaded = True
-        saved_data = load_user_data_from_sheets()
+        user_id = get_user_id()
+        try:
+            saved_data = load_user_data_from_local(user_id, len(st.session_state.questions))
+        except Exception as e:
+            saved_data = None
+            st.session_state.local_db_enabled = False
+            st.toast(f"ローカルDB読み込みエラー: {e}", icon="⚠️")
+        if saved_data is None:
+            saved_data = load_user_data_from_sheets()
+            if saved_data:
+                write_local_db(save_local_user_data, user_id, saved_data)
         
         if saved_data:
-            st.session_state.history = {int(k): v for k, v in saved_data.get("history", {}).items()}
-            st.session_state.marked_questions = set(saved_data.get("marked", []))
+            if saved_data["history"] is not None:
+                st.session_state.correct_bits, st.session_state.history_attempts = saved_data["history"]
+            st.session_state.marked_questions = SortedSet(saved_data.get("marked", []))
             st.session_state.current_session_stats = saved_data.get("stats", {"correct": 0, "incorrect": 0, "total": 0})
             # 最後に表示した問題インデックスを復元
             st.session_state.last_question_index = saved_data.get("last_question_index", 0)
@@ -285,58 +773,145 @@ def initialize_session_state():
     if "selected_options" not in st.session_state:
         st.session_state.selected_options = []
     if "marked_questions" not in st.session_state:
-        st.session_state.marked_questions = set()
-    if "history" not in st.session_state:
-        st.session_state.history = {}
+        st.session_state.marked_questions = SortedSet()  # 常に問題番号順
+    if "history_attempts" not in st.session_state:
+        reset_history()
+    if "answered_bits" not in st.session_state:
+        rebuild_answered_bits()
     if "shuffle_mode" not in st.session_state:
         st.session_state.shuffle_mode = False
     if "shuffled_indices" not in st.session_state:
-        st.session_state.shuffled_indices = list(range(len(st.session_state.questions)))
+        st.session_state.shuffled_indices = np.arange(len(st.session_state.questions))
     if "filter_modes" not in st.session_state:
         st.session_state.filter_modes = {"answered", "unanswered"}  # デフォルトで回答済みと未回答の両方
     if "current_session_stats" not in st.session_state:
         st.session_state.current_session_stats = {"correct": 0, "incorrect": 0, "total": 0}
 
 
+# 保存形式のタグ。base64は "+" で始まることがあり、Sheetsが数式として
+# 解釈しないよう、数式にならない文字で始める
+HISTORY_FORMAT_PREFIX = "b1:"
+
+
+def bits_to_mask(bits, n):
+    """uint64のビット列をn要素のbool配列に展開"""
+    return np.unpackbits(bits.astype("<u8").view(np.uint8), count=n, bitorder="little").view(bool)
+
+
+def mask_to_bits(mask):
+    """bool配列を64問ずつuint64に詰めたビット列に変換"""
+    packed = np.zeros(-(-len(mask) // 64) * 8, dtype=np.uint8)
+    packed[:(len(mask) + 7) // 8] = np.packbits(mask, bitorder="little")
+    return packed.view("<u8").astype(np.uint64)
+
+
+def count_bits(bits):
+    """ビット列で立っているビットの数"""
+    return int(np.unpackbits(bits.view(np.uint8)).sum())
+
+
+def new_history(num_questions):
+    """空の回答履歴（正解ビット列, 回答回数の配列）を作成"""
+    return np.zeros(-(-num_questions // 64), dtype=np.uint64), array("H", [0]) * num_questions
+
+
+def reset_history():
+    """回答履歴を空にする"""
+    st.session_state.correct_bits, st.session_state.history_attempts = new_history(len(st.session_state.questions))
+    rebuild_answered_bits()
+
+
+def encode_history(correct_bits, attempts):
+    """回答履歴を保存用の文字列（HISTORY_FORMAT_PREFIX + 正解ビット列と回答回数のbase64）に変換
+
+    実行環境のバイト順によらず同じ文字列になるよう、どちらもリトルエンディアンで詰める。
+    """
+    correct_bytes = correct_bits.astype("<u8").tobytes()[:(len(attempts) + 7) // 8]
+    attempts_bytes = np.asarray(attempts, dtype="<u2").tobytes()
+    return HISTORY_FORMAT_PREFIX + base64.b64encode(correct_bytes + attempts_bytes).decode("ascii")
+
+
+def decode_history(value, num_questions):
+    """保存された回答履歴を（正解ビット列, 回答回数の配列）に戻す"""
+    _, attempts = new_history(num_questions)
+    correct_mask = np.zeros(num_questions, dtype=bool)
+    if not value.startswith(HISTORY_FORMAT_PREFIX):
+        # 旧形式: {"問題インデックス": {"correct": bool, "attempts": int}} のJSON
+        for k, h in orjson.loads(value).items():
+            i = int(k)
+            if i < num_questions:
+                attempts[i] = min(h["attempts"], 0xFFFF)
+                correct_mask[i] = h["correct"]
+        return mask_to_bits(correct_mask), attempts
+    
+    raw = base64.b64decode(value[len(HISTORY_FORMAT_PREFIX):])
+    # 保存時の問題数nは len(raw) == ceil(n/8) + 2n から求める
+    n = len(raw) * 8 // 17
+    while (n + 7) // 8 + 2 * n > len(raw):
+        n -= 1
+    stored_attempts = np.frombuffer(raw, dtype="<u2", count=n, offset=(n + 7) // 8)
+    # 問題数が変わっていても、共通する範囲だけ復元する
+    n = min(n, num_questions)
+    correct_mask[:n] = np.unpackbits(np.frombuffer(raw, dtype=np.uint8), count=n, bitorder="little")
+    attempts[:n] = array("H", stored_attempts[:n].tolist())
+    return mask_to_bits(correct_mask), attempts
+
+
+def record_answer(question_idx, is_correct):
+    """回答結果を履歴に記録"""
+    attempts = st.session_state.history_attempts
+    attempts[question_idx] = min(attempts[question_idx] + 1, 0xFFFF)
+    word, bit = question_idx >> 6, np.uint64(1 << (question_idx & 63))
+    st.session_state.answered_bits[word] |= bit
+    if is_correct:
+        st.session_state.correct_bits[word] |= bit
+    else:
+        st.session_state.correct_bits[word] &= ~bit
+    write_local_db(save_local_answer, get_user_id(), question_idx, is_correct, attempts[question_idx])
+
+
+def rebuild_answered_bits():
+    """回答回数から回答済みのビット列を作り直す"""
+    attempts = np.frombuffer(st.session_state.history_attempts, dtype=np.uint16)
+    st.session_state.answered_bits = mask_to_bits(attempts > 0)
+
+
 def get_filtered_indices():
     """フィルターに基づいて問題インデックスを取得（複数フィルター対応）"""
-    all_indices = st.session_state.shuffled_indices if st.session_state.shuffle_mode else list(range(len(st.session_state.questions)))
+    num_questions = len(st.session_state.questions)
+    all_indices = st.session_state.shuffled_indices if st.session_state.shuffle_mode else np.arange(num_questions)
     
     filter_modes = st.session_state.filter_modes
     
     # 何も選択されていない場合は全問題を返す
     if not filter_modes:
-        return all_indices
+        return all_indices.tolist()
     
-    # 複数フィルターの条件を満たす問題を収集（OR条件）
-    result = set()
+    # 複数フィルターの条件を満たす問題をbool配列で収集（OR条件）
+    answered = bits_to_mask(st.session_state.answered_bits, num_questions)
+    result = np.zeros(num_questions, dtype=bool)
     
     if "marked" in filter_modes:
-        result.update(i for i in all_indices if i in st.session_state.marked_questions)
+        marked = np.fromiter(st.session_state.marked_questions, dtype=np.int64, count=len(st.session_state.marked_questions))
+        result[marked[marked < num_questions]] = True
     
     if "incorrect" in filter_modes:
-        result.update(i for i in all_indices if i in st.session_state.history and not st.session_state.history[i]["correct"])
+        result |= answered & ~bits_to_mask(st.session_state.correct_bits, num_questions)
     
     if "unanswered" in filter_modes:
-        result.update(i for i in all_indices if i not in st.session_state.history)
+        result |= ~answered
     
     if "answered" in filter_modes:
-        result.update(i for i in all_indices if i in st.session_state.history)
+        result |= answered
     
     # 元の順序を維持
-    return [i for i in all_indices if i in result]
-
-
-def count_correct_options(question):
-    return sum(1 for opt in question["options"] if opt["status"] == "correct")
+    return all_indices[result[all_indices]].tolist()
 
 
 def check_answer_with_shuffle(question, selected_display_indices, option_order):
     """シャッフルされた選択肢での回答をチェック"""
     # 表示上のインデックスを元のインデックスに変換
-    original_indices = [option_order[i] for i in selected_display_indices]
-    correct_indices = {i for i, opt in enumerate(question["options"]) if opt["status"] == "correct"}
-    return set(original_indices) == correct_indices
+    return frozenset(option_order[i] for i in selected_display_indices) == question["_correct_set"]
 
 
 # =============================================================================
@@ -354,7 +929,8 @@ def go_to_next_question():
     # 次の問題では新しい選択肢順序
     reset_option_orders()
     # 現在の問題をDBに保存
-    save_user_data_to_sheets()
+    mark_dirty("last_question_index")
+    save_user_data()
     st.rerun()
 
 
@@ -368,14 +944,23 @@ def go_to_prev_question():
     st.session_state.selected_options = []
     reset_option_orders()
     # 現在の問題をDBに保存
-    save_user_data_to_sheets()
+    mark_dirty("last_question_index")
+    save_user_data()
     st.rerun()
 
 
+def retry_question():
+    """同じ問題をもう一度解く"""
+    st.session_state.answered = False
+    st.session_state.selected_options = []
+    reset_option_orders()
+
+
 # =============================================================================
 # UI表示
 # =============================================================================
 
+@st.fragment
 def display_compact_header():
     """コンパクトなヘッダー"""
     stats = st.session_state.current_session_stats
@@ -405,13 +990,14 @@ def display_compact_header():
         if st.button("▶", key="next_btn", use_container_width=True):
             go_to_next_question()
     with nav_cols[2]:
-        correct_count = count_correct_options(st.session_state.questions[question_idx])
+        correct_count = st.session_state.questions[question_idx]["_correct_count"]
         if correct_count > 1:
             st.markdown(f"<span class='badge badge-count'>正解{correct_count}つ</span>", unsafe_allow_html=True)
 
 
+@st.fragment
 def display_question():
-    """問題を表示"""
+    """問題を表示（選択肢の操作ではこの部分だけを再実行）"""
     filtered_indices = get_filtered_indices()
     
     if not filtered_indices:
@@ -442,9 +1028,9 @@ def display_question():
     option_order = get_shuffled_options(question_idx)
     
     # 問題文
-    st.markdown(f'<div class="question-box">{question["question"]}</div>', unsafe_allow_html=True)
+    st.markdown(question["_question_html"], unsafe_allow_html=True)
     
-    correct_count = count_correct_options(question)
+    correct_count = question["_correct_count"]
     
     # お気に入りマークボタン（常に表示）
     mark_label = "⭐ お気に入り解除" if question_idx in st.session_state.marked_questions else "☆ お気に入り登録"
@@ -453,54 +1039,55 @@ def display_question():
             st.session_state.marked_questions.remove(question_idx)
         else:
             st.session_state.marked_questions.add(question_idx)
-        save_user_data_to_sheets()
+        write_local_db(save_local_marked, get_user_id(), question_idx, question_idx in st.session_state.marked_questions)
+        mark_dirty("marked")
+        save_user_data()
         st.rerun()
     
     if not st.session_state.answered:
-        # シャッフルされた選択肢を表示
-        shuffled_options = [question["options"][i] for i in option_order]
-        
-        if correct_count == 1:
-            selected = st.radio(
-                "選択:",
-                options=range(len(shuffled_options)),
-                format_func=lambda x: shuffled_options[x]["text"],
-                key=f"radio_{question_idx}_{st.session_state.shuffle_seed}",
-                label_visibility="collapsed"
-            )
-            st.session_state.selected_options = [selected] if selected is not None else []
-        else:
-            selected = []
-            for i, opt in enumerate(shuffled_options):
-                if st.checkbox(opt["text"], key=f"check_{question_idx}_{i}_{st.session_state.shuffle_seed}"):
-                    selected.append(i)
-            st.session_state.selected_options = selected
-        
-        if st.button("✓ 解答", type="primary", use_container_width=True):
-            if st.session_state.selected_options:
-                st.session_state.answered = True
-                is_correct = check_answer_with_shuffle(question, st.session_state.selected_options, option_order)
-                
-                # 履歴更新
-                if question_idx not in st.session_state.history:
-                    st.session_state.history[question_idx] = {"correct": is_correct, "attempts": 1}
-                else:
-                    st.session_state.history[question_idx]["attempts"] += 1
-                    st.session_state.history[question_idx]["correct"] = is_correct
-                
-                # 統計更新
-                st.session_state.current_session_stats["total"] += 1
-                if is_correct:
-                    st.session_state.current_session_stats["correct"] += 1
-                else:
-                    st.session_state.current_session_stats["incorrect"] += 1
-                
-                # Google Sheetsに保存
-                save_user_data_to_sheets()
-                
-                st.rerun()
+        # 選択肢はフォームにまとめ、選択の操作ごとには再実行せず解答時に一度だけ処理する
+        with st.form("answer_form", border=False):
+            # シャッフルされた選択肢を表示
+            shuffled_options = [question["options"][i] for i in option_order]
+            
+            if correct_count == 1:
+                selected = st.radio(
+                    "選択:",
+                    options=range(len(shuffled_options)),
+                    format_func=lambda x: shuffled_options[x]["text"],
+                    key=f"radio_{question_idx}_{st.session_state.shuffle_seed}",
+                    label_visibility="collapsed"
+                )
+                st.session_state.selected_options = [selected] if selected is not None else []
             else:
-                st.warning("選択してください")
+                selected = []
+                for i, opt in enumerate(shuffled_options):
+                    if st.checkbox(opt["text"], key=f"check_{question_idx}_{i}_{st.session_state.shuffle_seed}"):
+                        selected.append(i)
+                st.session_state.selected_options = selected
+            
+            if st.form_submit_button("✓ 解答", type="primary", use_container_width=True):
+                if st.session_state.selected_options:
+                    st.session_state.answered = True
+                    is_correct = check_answer_with_shuffle(question, st.session_state.selected_options, option_order)
+                    
+                    # 履歴更新
+                    record_answer(question_idx, is_correct)
+                    
+                    # 統計更新
+                    st.session_state.current_session_stats["total"] += 1
+                    if is_correct:
+                        st.session_state.current_session_stats["correct"] += 1
+                    else:
+                        st.session_state.current_session_stats["incorrect"] += 1
+                    
+                    # Google Sheetsに保存
+                    mark_dirty("history", "stats")
+                    save_user_data()
+                    
+                    st.rerun()
+                else:
+                    st.warning("選択してください")
     else:
         # 回答済み
         is_correct = check_answer_with_shuffle(question, st.session_state.selected_options, option_order)
@@ -514,7 +1101,7 @@ def display_question():
         for display_idx, original_idx in enumerate(option_order):
             opt = question["options"][original_idx]
             is_selected = display_idx in st.session_state.selected_options
-            is_correct_opt = opt["status"] == "correct"
+            is_correct_opt = original_idx in question["_correct_set"]
             
             if is_correct_opt:
                 st.markdown(f'<div class="correct-answer">✅ {opt["text"]}{"【選択】" if is_selected else ""}</div>', unsafe_allow_html=True)
@@ -524,17 +1111,14 @@ def display_question():
                 st.write(f"　{opt['text']}")
         
         # 解説
-        if question.get("explanation"):
-            st.markdown(f'<div class="explanation-box">📖 <b>解説</b><br>{question["explanation"]}</div>', unsafe_allow_html=True)
+        if question["_explanation_html"]:
+            st.markdown(question["_explanation_html"], unsafe_allow_html=True)
         
         # ボタン
         btn_cols = st.columns(2)
         with btn_cols[0]:
-            if st.button("🔄 もう一度", use_container_width=True):
-                st.session_state.answered = False
-                st.session_state.selected_options = []
-                reset_option_orders()
-                st.rerun()
+            # コールバックで状態を戻すので、フラグメントの再実行だけで再描画される
+            st.button("🔄 もう一度", use_container_width=True, on_click=retry_question)
         with btn_cols[1]:
             if st.button("次へ ▶", type="primary", use_container_width=True):
                 go_to_next_question()
@@ -550,11 +1134,14 @@ def display_settings():
     # 問題フィルター（複数選択対応）
     st.markdown("**問題フィルター:**")
     
+    # 件数は一度だけ数えて使い回す
+    num_questions = len(st.session_state.questions)
+    num_answered = count_bits(st.session_state.answered_bits)
     filter_counts = {
         "marked": len(st.session_state.marked_questions),
-        "incorrect": len([i for i in st.session_state.history if not st.session_state.history[i]['correct']]),
-        "answered": len(st.session_state.history),
-        "unanswered": len(st.session_state.questions) - len(st.session_state.history)
+        "incorrect": count_bits(st.session_state.answered_bits & ~st.session_state.correct_bits),
+        "answered": num_answered,
+        "unanswered": num_questions - num_answered
     }
     
     filter_labels = {
@@ -612,18 +1199,19 @@ def display_settings():
         st.session_state.filter_modes = new_modes
         st.session_state.current_index = 0
         st.session_state.answered = False
+        mark_dirty("last_question_index")
+        save_user_data(force=True)
         st.rerun()
     
-    # 現在のフィルター結果を表示
-    filtered_count = len(get_filtered_indices())
-    st.caption(f"フィルター結果: {filtered_count}問")
+    # 現在のフィルター結果を表示（フィルター変更時は上で再実行済み）
+    filtered_indices = get_filtered_indices()
+    st.caption(f"フィルター結果: {len(filtered_indices)}問")
     
     shuffle = st.toggle("🔀 問題順シャッフル", value=st.session_state.shuffle_mode)
     if shuffle != st.session_state.shuffle_mode:
         st.session_state.shuffle_mode = shuffle
         if shuffle:
-            st.session_state.shuffled_indices = list(range(len(st.session_state.questions)))
-            random.shuffle(st.session_state.shuffled_indices)
+            st.session_state.shuffled_indices = np.random.default_rng().permutation(num_questions)
         st.session_state.current_index = 0
         st.session_state.answered = False
         st.rerun()
@@ -631,12 +1219,11 @@ def display_settings():
     st.divider()
     
     st.markdown("### 🔢 問題に移動")
-    filtered_indices = get_filtered_indices()
     if filtered_indices:
         jump_to = st.number_input(
             "問題番号",
             min_value=1,
-            max_value=len(st.session_state.questions),
+            max_value=num_questions,
             value=filtered_indices[st.session_state.current_index] + 1,
             step=1
         )
@@ -649,7 +1236,8 @@ def display_settings():
                 st.session_state.current_index = target_idx
             st.session_state.answered = False
             reset_option_orders()
-            save_user_data_to_sheets()
+            mark_dirty("last_question_index")
+            save_user_data()
             st.rerun()
     
     st.divider()
@@ -658,14 +1246,18 @@ def display_settings():
     col1, col2 = st.columns(2)
     with col1:
         if st.button("履歴クリア", use_container_width=True):
-            st.session_state.history = {}
+            reset_history()
+            write_local_db(clear_local_table, get_user_id(), "history")
             st.session_state.current_session_stats = {"correct": 0, "incorrect": 0, "total": 0}
-            save_user_data_to_sheets()
+            mark_dirty("history", "stats")
+            save_user_data(force=True)
             st.rerun()
     with col2:
         if st.button("マーククリア", use_container_width=True):
-            st.session_state.marked_questions = set()
-            save_user_data_to_sheets()
+            st.session_state.marked_questions = SortedSet()
+            write_local_db(clear_local_table, get_user_id(), "marked")
+            mark_dirty("marked")
+            save_user_data(force=True)
             st.rerun()
 
 
@@ -677,7 +1269,7 @@ def display_marked_list():
     
     st.markdown(f"### ⭐ マーク済み ({len(st.session_state.marked_questions)}問)")
     
-    for idx in sorted(st.session_state.marked_questions):
+    for idx in st.session_state.marked_questions:
         q = st.session_state.questions[idx]
         short_q = q['question'][:40] + "..." if len(q['question']) > 40 else q['question']
         
@@ -690,15 +1282,16 @@ def display_marked_list():
                 st.session_state.current_index = idx
                 st.session_state.answered = False
                 reset_option_orders()
-                save_user_data_to_sheets()
+                mark_dirty("last_question_index")
+                save_user_data()
                 st.rerun()
 
 
 def display_stats():
     """統計"""
     total = len(st.session_state.questions)
-    answered = len(st.session_state.history)
-    correct = sum(1 for h in st.session_state.history.values() if h["correct"])
+    answered = count_bits(st.session_state.answered_bits)
+    correct = count_bits(st.session_state.correct_bits)
     marked = len(st.session_state.marked_questions)
     
     st.markdown("### 📊 統計")
@@ -723,8 +1316,11 @@ def display_stats():
 
 
 def main():
+    inject_css()
     initialize_session_state()
     get_user_id()  # URLにユーザーIDを設定
+    # 保留中の保存を画面遷移の区切りで書き込む
+    flush_pending_save()
     
     display_compact_header()
     